@@ -0,0 +1,344 @@
+# Microbenchmarks for the BlynkLib hot paths.
+#
+# Everything runs offline: the Blynk connection is a fake socket and the
+# Omega GPIO sysfs tree is faked in a temporary directory.  The results are
+# written as JSON so the numbers of two releases can be compared.
+#
+# Example usage:
+#
+#     python BlynkBenchmark.py --output new.json
+#     python BlynkBenchmark.py --output new.json --compare old.json
+#
+# With --compare, every benchmark that is slower than the old result by more
+# than --threshold is reported and the exit code is 1.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import BlynkLib
+import OmegaGPIOHelper
+
+DEFAULT_OUTPUT = 'benchmark_results.json'
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.10  # 10% slower is a regression
+
+
+class FakeSocket:
+    """
+    Socket stand in.  recv returns the 'stream' bytes in chunks of at most
+    'chunk' bytes, and starts over at the end of the stream.  send only
+    counts the bytes.
+    """
+    def __init__(self, stream=b'', chunk=None):
+        self.stream = stream
+        self.chunk = chunk
+        self.pos = 0
+        self.sent = 0
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self, length):
+        if self.chunk is not None:
+            length = min(length, self.chunk)
+        if self.pos >= len(self.stream):
+            self.pos = 0
+        data = self.stream[self.pos:self.pos + length]
+        self.pos += len(data)
+        return data
+
+    def send(self, data):
+        self.sent += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class FakeGPIO:
+    def setMode(self, pin, mode):
+        pass
+
+    def setPin(self, pin, value):
+        pass
+
+    def getPin(self, pin):
+        return 1
+
+
+def new_blynk(conn=None):
+    blynk = BlynkLib.Blynk('benchmark', connect=False)
+    blynk.conn = conn if conn is not None else FakeSocket()
+    blynk.state = BlynkLib.AUTHENTICATED
+    blynk._rx_data = b''
+    blynk._timeout = None
+    blynk._pins_configured = True
+    return blynk
+
+
+def time_loop(func, number, repeat):
+    """
+    Call 'func' 'number' times, 'repeat' times over.
+    :return: dictionary with the best and median operations per second
+    """
+    rates = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        rates.append(number / (time.perf_counter() - start))
+    rates.sort()
+    return {'ops_per_sec': rates[-1], 'median_ops_per_sec': rates[len(rates) // 2], 'number': number}
+
+
+def bench_format_msg(repeat):
+    blynk = new_blynk()
+    encoder = blynk._encoder
+    return {
+        'format_msg.generic': time_loop(lambda: blynk._format_msg(BlynkLib.MSG_HW, 'vw', 12, 123), 200000, repeat),
+        'format_msg.vw_int': time_loop(lambda: encoder.encode_pin('vw', 1, 12, 123), 200000, repeat),
+        'format_msg.vw_float': time_loop(lambda: encoder.encode_pin('vw', 1, 12, 21.5), 200000, repeat),
+        'format_msg.vw_str': time_loop(lambda: encoder.encode_pin('vw', 1, 12, 'on'), 200000, repeat),
+    }
+
+
+def bench_recv(repeat):
+    frames = 1000
+    stream = b''.join(BlynkLib.HDR.pack(BlynkLib.MSG_HW, i + 1, 9) + b'vw\x0012\x00123' for i in range(frames))
+
+    def run(chunk):
+        blynk = new_blynk(FakeSocket(stream, chunk))
+
+        def read_frames():
+            count = 0
+            while count < frames:
+                data = blynk._recv(BlynkLib.HDR_LEN)
+                if not data:
+                    continue
+                msg_type, msg_id, msg_len = BlynkLib.HDR.unpack(data)
+                while not blynk._recv(msg_len):
+                    pass
+                count += 1
+
+        result = time_loop(read_frames, 20, repeat)
+        for key in ('ops_per_sec', 'median_ops_per_sec'):
+            result[key] *= frames
+        result['number'] *= frames
+        return result
+
+    return {
+        'recv.coalesced': run(None),
+        'recv.fragmented_3': run(3),
+        'recv.fragmented_1': run(1),
+    }
+
+
+def bench_handle_hw(repeat):
+    blynk = new_blynk()
+
+    def read_handler(pin, state, blynk_ref):
+        return 1
+
+    def write_handler(value, pin, state, blynk_ref):
+        pass
+
+    blynk.add_virtual_pin(1, read=read_handler, write=write_handler)
+    blynk.add_digital_hw_pin(2, read=read_handler, write=write_handler)
+    blynk.add_analog_hw_pin(3, read=read_handler, write=write_handler)
+    commands = {
+        'pm': b'pm\x002\x00out\x003\x00in',
+        'vw': b'vw\x001\x00123',
+        'vr': b'vr\x001',
+        'dw': b'dw\x002\x001',
+        'dr': b'dr\x002',
+        'aw': b'aw\x003\x00512',
+        'ar': b'ar\x003',
+    }
+    results = {}
+    for cmd, data in commands.items():
+        def handle(data=data):
+            # keep the replies under the per second budget, so they are sent
+            # and not queued
+            blynk._reset_tx_budget()
+            blynk._handle_hw(data)
+        results['handle_hw.' + cmd] = time_loop(handle, 50000, repeat)
+
+    # pins served by a GPIO backend, without callbacks
+    blynk.bind_gpio(FakeGPIO())
+    blynk._handle_hw(b'pm\x004\x00out\x005\x00in')
+    for cmd, data in (('dw', b'dw\x004\x001'), ('dr', b'dr\x005')):
+        def handle(data=data):
+            blynk._reset_tx_budget()
+            blynk._handle_hw(data)
+        results['handle_hw.gpio_' + cmd] = time_loop(handle, 50000, repeat)
+    return results
+
+
+def bench_user_task(repeat, ticks=100, period=0.01, calls_per_repeat=200):
+    """
+    Measure the overhead of a UserTask.run_task call with a no-op handler,
+    and run a UserTask with a short period to measure how late each call is.
+    Both are done 'repeat' times, the lateness samples of all runs are pooled.
+    """
+    # overhead: each run_task call schedules its next call on a new Timer,
+    # so use a long period and cancel the timers afterwards
+    task = BlynkLib.UserTask(lambda task_state, blynk_ref: None, 3600, new_blynk(), authenticated=False)
+    before = set(threading.enumerate())
+    overhead = time_loop(task.run_task, calls_per_repeat, repeat)
+    for the_thread in threading.enumerate():
+        if the_thread not in before and isinstance(the_thread, threading.Timer):
+            the_thread.cancel()
+    overhead['us_per_call'] = 1e6 / overhead['ops_per_sec']
+
+    late_ms = []
+    for _ in range(repeat):
+        calls = []
+
+        def task_handler(task_state, blynk_ref):
+            calls.append(time.time())
+
+        task = BlynkLib.UserTask(task_handler, period, new_blynk(), authenticated=False)
+        task.run_task()
+        while len(calls) < ticks + 1:
+            time.sleep(period)
+        # UserTask has no stop, so push the next call far into the future
+        task.task_handler = None
+        task.period_in_seconds = 3600
+        late_ms.extend((calls[i + 1] - calls[i] - period) * 1000 for i in range(ticks))
+
+    late_ms.sort()
+    return {
+        'user_task.run_task': overhead,
+        'user_task.lateness': {
+            'period_ms': period * 1000,
+            'ticks': len(late_ms),
+            'mean_ms': sum(late_ms) / len(late_ms),
+            'p50_ms': late_ms[len(late_ms) // 2],
+            'p99_ms': late_ms[min(len(late_ms) - 1, int(len(late_ms) * 0.99))],
+            'max_ms': late_ms[-1],
+            'jitter_ms': late_ms[-1] - late_ms[0],
+        }
+    }
+
+
+def bench_gpio(repeat):
+    pins = [0, 1, 6, 7]
+    root = tempfile.mkdtemp(prefix='blynk-gpio-')
+    cwd = os.getcwd()
+    try:
+        for pin in pins:
+            os.makedirs(os.path.join(root, 'gpio%d' % pin))
+            for name, value in (('direction', 'in'), ('value', '0')):
+                with open(os.path.join(root, 'gpio%d' % pin, name), 'w') as f:
+                    f.write(value)
+        open(os.path.join(root, 'export'), 'w').close()
+        # used by OmegaGPIOHelper when not running on Linux
+        os.makedirs(os.path.join(root, 'gpio'))
+        for pin in pins:
+            with open(os.path.join(root, 'gpio', '%d.txt' % pin), 'w') as f:
+                f.write('0')
+        os.chdir(root)
+
+        class FakeSysfsGPIOHelper(OmegaGPIOHelper.OmegaGPIOHelper):
+            exportPath = os.path.join(root, 'export')
+            pinDirectionPath = os.path.join(root, 'gpio$', 'direction')
+            pinValuePath = os.path.join(root, 'gpio$', 'value')
+
+        FakeSysfsGPIOHelper.pins = pins
+        gpio = FakeSysfsGPIOHelper()
+        results = {
+            'gpio.set_pin': time_loop(lambda: gpio.setPin(6, 1), 5000, repeat),
+            'gpio.get_pin': time_loop(lambda: gpio.getPin(6), 5000, repeat),
+        }
+        # with the pin modes set, as done by BlynkLib bind_gpio
+        gpio.setMode(0, 'out')
+        gpio.setMode(1, 'in')
+        results['gpio.set_pin_mode_set'] = time_loop(lambda: gpio.setPin(0, 1), 5000, repeat)
+        results['gpio.get_pin_mode_set'] = time_loop(lambda: gpio.getPin(1), 5000, repeat)
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+
+BENCHMARKS = [bench_format_msg, bench_recv, bench_handle_hw, bench_user_task, bench_gpio]
+
+
+def run_benchmarks(repeat=DEFAULT_REPEAT):
+    results = {}
+    for bench in BENCHMARKS:
+        results.update(bench(repeat))
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(new, old, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare two result sets.  Throughput benchmarks regress when
+    ops_per_sec drops, the user task benchmark when p99_ms grows.
+    :return: list of (name, old value, new value) for every regression
+    """
+    regressions = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        old_result = old['results'][name]
+        if 'ops_per_sec' in result:
+            if result['ops_per_sec'] < old_result['ops_per_sec'] * (1 - threshold):
+                regressions.append((name, old_result['ops_per_sec'], result['ops_per_sec']))
+        elif 'p99_ms' in result:
+            # lateness is a few ms at best, do not flag noise below 1 ms
+            if result['p99_ms'] > max(old_result['p99_ms'] * (1 + threshold), old_result['p99_ms'] + 1):
+                regressions.append((name, old_result['p99_ms'], result['p99_ms']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='BlynkLib microbenchmarks')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='fraction a benchmark may be slower before it is a regression')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    for name, result in sorted(results['results'].items()):
+        if 'ops_per_sec' in result:
+            print('%-28s %14.0f ops/s' % (name, result['ops_per_sec']))
+        else:
+            print('%-28s p50 %.2f ms  p99 %.2f ms  max %.2f ms late' % (name, result['p50_ms'], result['p99_ms'],
+                                                                     result['max_ms']))
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(results, old, args.threshold)
+        for name, old_value, new_value in regressions:
+            print('REGRESSION %s: %.2f -> %.2f' % (name, old_value, new_value))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
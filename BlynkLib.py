@@ -18,6 +18,16 @@
 #                   blynk server
 # Changes 6/10/2017
 # * all user tasks to run without being authenticated with blynk server
+# Changes 10/18/2026
+# * outbound messages are sent by priority class (control, interactive,
+#   telemetry, bulk).  Each class has its own share of the per second
+#   budget and its own counters, see 'tx_stats'
+# * add 'cache_ttl' to the add_*_pin methods.  Read handler values are
+#   cached for cache_ttl seconds and concurrent reads share one handler call
+# * messages are encoded by FrameEncoder, which works with Python 3 and
+#   caches the encoded pin write prefixes
+# * add 'bind_gpio' method.  Pins configured by the app 'pm' command are
+#   served from a GPIO backend directly, without user callbacks
 # TODO
 # * all for run to be async in the background
 
@@ -92,14 +102,33 @@ import socket
 import struct
 import time
 import threading
+from collections import deque
 
 const = lambda x: x
 
 HDR_LEN = const(5)
 HDR_FMT = "!BHH"
+HDR = struct.Struct(HDR_FMT)
 
 MAX_MSG_PER_SEC = const(20)
 
+# outbound priority classes, lower value is sent first
+PRIO_CONTROL = const(0)  # login, heartbeat and ping responses
+PRIO_INTERACTIVE = const(1)  # dr/ar/vr replies the app is waiting for
+PRIO_TELEMETRY = const(2)  # virtual_write from user code
+PRIO_BULK = const(3)  # notify, tweet, email
+
+# maximum number of the MAX_MSG_PER_SEC budget each class may use.
+# control messages are never limited.  Telemetry and bulk can not use
+# the whole budget, so there is always room left for interactive replies
+TX_BUDGET_SHARE = {
+    PRIO_CONTROL: None,
+    PRIO_INTERACTIVE: MAX_MSG_PER_SEC,
+    PRIO_TELEMETRY: const(14),
+    PRIO_BULK: const(2),
+}
+TX_QUEUE_LEN = const(64)
+
 MSG_RSP = const(0)
 MSG_LOGIN = const(2)
 MSG_PING = const(6)
@@ -153,20 +182,178 @@ def sleep_from_until(start, delay):
     return start + delay
 
 
+class ReadCache:
+    """
+    Read-through cache for a pin read handler.  The value returned by the
+    handler is served for 'ttl' seconds.  When several threads read at the
+    same time, only one calls the handler and the others wait for its value.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._cond = threading.Condition(threading.Lock())
+        self._value = None
+        self._expires = 0
+        self._in_flight = False
+        self._generation = 0  # bumped by invalidate
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, loader):
+        with self._cond:
+            while True:
+                if time.time() < self._expires:
+                    self.hits += 1
+                    return self._value
+                if not self._in_flight:
+                    break
+                self._cond.wait()
+            self._in_flight = True
+            self.misses += 1
+            generation = self._generation
+
+        value = None
+        loaded = False
+        try:
+            value = loader()
+            loaded = True
+        finally:
+            with self._cond:
+                # a value read before an invalidate may predate a write, do not keep it
+                if loaded and generation == self._generation:
+                    self._value = value
+                    self._expires = time.time() + self.ttl
+                # on error or NoValueToReport nothing is cached and the
+                # next waiter calls the handler itself
+                self._in_flight = False
+                self._cond.notify_all()
+        return value
+
+    def invalidate(self):
+        with self._cond:
+            self._expires = 0
+            self._generation += 1
+
+
 class VrPin:
-    def __init__(self, read=None, write=None, blynk_ref=None, initial_state=None):
+    def __init__(self, read=None, write=None, blynk_ref=None, initial_state=None, cache_ttl=None):
         self.read = read
         self.write = write
         self.state = initial_state if initial_state is not None else {}
         self.blynk_ref = blynk_ref
+        self.cache = ReadCache(cache_ttl) if read is not None and cache_ttl else None
 
+    def read_value(self, pin):
+        if self.cache is None:
+            return self.read(pin, self.state, self.blynk_ref)
+        return self.cache.get(lambda: self.read(pin, self.state, self.blynk_ref))
 
-class HwPin:
-    def __init__(self, read=None, write=None, blynk_ref=None, initial_state=None):
-        self.read = read
-        self.write = write
-        self.state = initial_state if initial_state is not None else {}
-        self.blynk_ref = blynk_ref
+    def write_value(self, value, pin):
+        self.write(value, pin, self.state, self.blynk_ref)
+        # the next read must see the written value, not the cached one
+        if self.cache is not None:
+            self.cache.invalidate()
+
+
+class HwPin(VrPin):
+    pass
+
+
+def _encode_arg(arg):
+    """
+    Encode a single message argument, with fast paths for the common types
+    """
+    arg_type = type(arg)
+    if arg_type is bytes:
+        return arg
+    if arg_type is int:
+        return b'%d' % arg
+    if arg_type is float:
+        return repr(arg).encode('ascii')
+    if arg_type is str:
+        return arg.encode('utf-8')
+    return str(arg).encode('utf-8')
+
+
+class FrameEncoder:
+    """
+    Encodes Blynk messages.  The header is packed with the precompiled HDR
+    struct, and the 'vw\\0<pin>\\0' style prefixes of pin writes are
+    encoded once per pin and reused.
+    """
+    def __init__(self):
+        self._prefixes = {}
+
+    def header(self, msg_type, msg_id, length):
+        return HDR.pack(msg_type, msg_id, length)
+
+    def encode(self, msg_type, msg_id, *args):
+        data = b'\0'.join([_encode_arg(arg) for arg in args])
+        return HDR.pack(msg_type, msg_id, len(data)) + data
+
+    def encode_pin(self, cmd, msg_id, pin, val):
+        """
+        Encode a MSG_HW pin message such as 'vw', 'dw' or 'aw'
+        """
+        prefix = self._prefixes.get((cmd, pin))
+        if prefix is None:
+            prefix = _encode_arg(cmd) + b'\0' + _encode_arg(pin) + b'\0'
+            self._prefixes[(cmd, pin)] = prefix
+        data = _encode_arg(val)
+        return HDR.pack(MSG_HW, msg_id, len(prefix) + len(data)) + prefix + data
+
+
+class TxClass:
+    """
+    Outbound queue and counters for a single priority class
+    """
+    def __init__(self, priority, share, queue_len=TX_QUEUE_LEN):
+        self.priority = priority
+        self.share = share
+        self.queue = deque()  # [key, data] entries, oldest first
+        self.queue_len = queue_len
+        self._keyed = {}  # key -> queued entry, for coalescing
+        self.used = 0  # messages sent in the current second
+        self.sent = 0
+        self.queued = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def has_budget(self):
+        return self.share is None or self.used < self.share
+
+    def enqueue(self, data, key=None):
+        """
+        Queue a message.  A message with the same key as one that is still
+        queued replaces it, so only the latest value of e.g. a pin is sent.
+        """
+        if key is not None and key in self._keyed:
+            self._keyed[key][1] = data
+            self.coalesced += 1
+            return
+        if len(self.queue) >= self.queue_len:
+            # the oldest message is the most stale one
+            self.dequeue()
+            self.dropped += 1
+        entry = [key, data]
+        self.queue.append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+        self.queued += 1
+
+    def dequeue(self):
+        key, data = self.queue.popleft()
+        if key is not None:
+            del self._keyed[key]
+        return data
+
+    def clear(self):
+        self.queue.clear()
+        self._keyed.clear()
+
+    def stats(self):
+        return {'sent': self.sent, 'queued': self.queued, 'dropped': self.dropped,
+                'coalesced': self.coalesced, 'pending': len(self.queue), 'used': self.used,
+                'share': self.share}
 
 
 class UserTask:
@@ -236,13 +423,56 @@ class Blynk:
         self._analog_hw_pins = {}
         self.user_tasks = []
         self.state = DISCONNECTED
-
+        self._tx_lock = threading.RLock()
+        self._tx_classes = [TxClass(prio, TX_BUDGET_SHARE[prio]) for prio in sorted(TX_BUDGET_SHARE)]
+        self._tx_count = 0
+        self._encoder = FrameEncoder()
+        self._msg_id = 1
+        self._gpio = None
+        self._gpio_pins = {}
 
     def _format_msg(self, msg_type, *args):
-        data = bytes('\0'.join(map(str, args)))
-        return struct.pack(HDR_FMT, msg_type, self._new_msg_id(), len(data)) + data
+        return self._encoder.encode(msg_type, self._new_msg_id(), *args)
+
+    def _handle_gpio(self, data):
+        """
+        Serve 'dw', 'dr', 'aw' and 'ar' for pins bound to the GPIO backend,
+        before the generic decode in _handle_hw.
+        :return: True if the command was handled
+        """
+        params = data.split(b'\0')
+        cmd = params[0]
+        if cmd != b'dw' and cmd != b'dr' and cmd != b'aw' and cmd != b'ar':
+            return False
+        pin = int(params[1])
+        mode = self._gpio_pins.get(pin)
+        if mode is None:
+            return False
+        if mode == 'out' and (cmd == b'dr' or cmd == b'ar'):
+            # reading through the backend would turn the output into an input
+            logging.getLogger().warn("Warning: Hardware pin: {} is an output, not reading it".format(pin))
+            return True
+        try:
+            if cmd == b'dw':
+                self._gpio_write(pin, int(params[2]))
+            elif cmd == b'dr':
+                self._send(self._encoder.encode_pin('dw', self._new_msg_id(), pin, self._gpio_read(pin)),
+                           priority=PRIO_INTERACTIVE)
+            elif cmd == b'aw' and self._gpio_analog_write is not None:
+                self._gpio_analog_write(pin, int(params[2]))
+            elif cmd == b'ar' and self._gpio_analog_read is not None:
+                self._send(self._encoder.encode_pin('aw', self._new_msg_id(), pin, self._gpio_analog_read(pin)),
+                           priority=PRIO_INTERACTIVE)
+            else:
+                return False
+        except Exception as exc:
+            logging.getLogger().error("Error in GPIO {}: {}".format(cmd.decode('ascii'), exc))
+        return True
 
     def _handle_hw(self, data):
+        # _gpio_pins is filled by 'pm' and cleared with _pins_configured in _run
+        if self._gpio_pins and self._handle_gpio(data):
+            return
         params = list(map(lambda x: x.decode('ascii'), data.split(b'\0')))
         cmd = params.pop(0)
         logging.getLogger().debug("command: {}".format(cmd))
@@ -250,25 +480,36 @@ class Blynk:
             pass
         elif cmd == 'pm':
             pairs = zip(params[0::2], params[1::2])
+            gpio_pins = {}
             for (pin, mode) in pairs:
                 pin = int(pin)
                 if mode != 'in' and mode != 'out' and mode != 'pu' and mode != 'pd':
                     raise ValueError("Unknown pin %d mode: %s" % (pin, mode))
                 logging.getLogger().debug("pm: pin: {}, mode: {}".format(pin, mode))
+                if self._gpio is not None and pin not in self._digital_hw_pins and pin not in self._analog_hw_pins:
+                    if self._gpio_set_mode is not None:
+                        try:
+                            self._gpio_set_mode(pin, mode)
+                        except Exception as exc:
+                            # leave the pin unbound, the other pins still work
+                            logging.getLogger().error("Error in GPIO pm for pin {}: {}".format(pin, exc))
+                            continue
+                    gpio_pins[pin] = mode
+            self._gpio_pins = gpio_pins
             self._pins_configured = True
         elif cmd == 'vw':
             pin = int(params.pop(0))
             if pin in self._vr_pins and self._vr_pins[pin].write:
                 for param in params:
-                    self._vr_pins[pin].write(param, pin, self._vr_pins[pin].state, self._vr_pins[pin].blynk_ref)
+                    self._vr_pins[pin].write_value(param, pin)
             else:
                 logging.getLogger().warn("Warning: Virtual write to unregistered pin %d" % pin)
         elif cmd == 'vr':
             pin = int(params.pop(0))
             if pin in self._vr_pins and self._vr_pins[pin].read:
                 try:
-                    val = self._vr_pins[pin].read(pin, self._vr_pins[pin].state, self._vr_pins[pin].blynk_ref)
-                    self.virtual_write(pin, val)
+                    val = self._vr_pins[pin].read_value(pin)
+                    self._virtual_write(pin, val, PRIO_INTERACTIVE)
                 except NoValueToReport as nvtr:
                     pass
                 except Exception as exc:
@@ -282,7 +523,7 @@ class Blynk:
                 val = int(params.pop(0))
                 if pin in self._digital_hw_pins:
                     if self._digital_hw_pins[pin].write is not None:
-                        self._digital_hw_pins[pin].write(val, pin, self._digital_hw_pins[pin].state, self._digital_hw_pins[pin].blynk_ref)
+                        self._digital_hw_pins[pin].write_value(val, pin)
                     else:
                         logging.getLogger().warn("Warning: Hardware pin: {} is setup, but has no digital 'write' callback.".format(pin))
                 else:
@@ -293,7 +534,7 @@ class Blynk:
                 val = int(params.pop(0))
                 if pin in self._analog_hw_pins:
                     if self._analog_hw_pins[pin].write is not None:
-                        self._analog_hw_pins[pin].write(val, pin, self._analog_hw_pins[pin].state, self._analog_hw_pins[pin].blynk_ref)
+                        self._analog_hw_pins[pin].write_value(val, pin)
                     else:
                         logging.getLogger().warn("Warning: Hardware pin: {} is setup, but has no analog 'write' callback.".format(pin))
                 else:
@@ -304,8 +545,8 @@ class Blynk:
                 if pin in self._digital_hw_pins:
                     if self._digital_hw_pins[pin].read is not None:
                         try:
-                            val = self._digital_hw_pins[pin].read(pin, self._digital_hw_pins[pin].state, self._digital_hw_pins[pin].blynk_ref)
-                            self._send(self._format_msg(MSG_HW, 'dw', pin, val))
+                            val = self._digital_hw_pins[pin].read_value(pin)
+                            self._send(self._encoder.encode_pin('dw', self._new_msg_id(), pin, val), priority=PRIO_INTERACTIVE)
                         except NoValueToReport as nvtr:
                             pass
                         except Exception as exc:
@@ -320,8 +561,8 @@ class Blynk:
                 if pin in self._analog_hw_pins:
                     if self._analog_hw_pins[pin].read is not None:
                         try:
-                            val = self._analog_hw_pins[pin].read(pin, self._analog_hw_pins[pin].state, self._analog_hw_pins[pin].blynk_ref)
-                            self._send(self._format_msg(MSG_HW, 'aw', pin, val))
+                            val = self._analog_hw_pins[pin].read_value(pin)
+                            self._send(self._encoder.encode_pin('aw', self._new_msg_id(), pin, val), priority=PRIO_INTERACTIVE)
                         except NoValueToReport as nvtr:
                             pass
                         except Exception as exc:
@@ -362,22 +603,91 @@ class Blynk:
         else:
             return b''
 
-    def _send(self, data, send_anyway=False):
-        if self._tx_count < MAX_MSG_PER_SEC or send_anyway:
-            retries = 0
-            while retries <= MAX_TX_RETRIES:
-                try:
-                    self.conn.send(data)
-                    self._tx_count += 1
+    def _send(self, data, send_anyway=False, priority=PRIO_TELEMETRY, key=None):
+        """
+        Send a message, or queue it when its priority class is out of
+        budget for the current second.  Queued messages are flushed by
+        '_flush_tx', highest priority class first.
+        :param data: the formatted message
+        :param send_anyway: send regardless of the budget, same as PRIO_CONTROL
+        :param priority: one of the PRIO_* classes
+        :param key: if queued, replaces a queued message with the same key
+        :return: None
+        """
+        if send_anyway:
+            priority = PRIO_CONTROL
+        with self._tx_lock:
+            tx_class = self._tx_classes[priority]
+            if priority == PRIO_CONTROL:
+                self._send_now(data, tx_class)
+            elif self._can_send(tx_class) and not self._tx_pending(priority):
+                self._send_now(data, tx_class)
+            else:
+                tx_class.enqueue(data, key)
+
+    def _can_send(self, tx_class):
+        return self._tx_count < MAX_MSG_PER_SEC and tx_class.has_budget()
+
+    def _tx_pending(self, priority):
+        # anything queued at the same priority, or at a higher priority
+        # that still has budget left, must go first
+        if self._tx_classes[priority].queue:
+            return True
+        for tx_class in self._tx_classes[1:priority]:
+            if tx_class.queue and tx_class.has_budget():
+                return True
+        return False
+
+    def _send_now(self, data, tx_class):
+        retries = 0
+        while retries <= MAX_TX_RETRIES:
+            try:
+                self.conn.send(data)
+                self._tx_count += 1
+                tx_class.used += 1
+                tx_class.sent += 1
+                break
+            except socket.error as er:
+                if er.args[0] != EAGAIN:
+                    raise
+                else:
+                    time.sleep(RE_TX_DELAY / 1000.0)
+                    retries += 1
+
+    def _flush_tx(self):
+        """
+        Send queued messages, highest priority class first, until the
+        budget for the current second is used up
+        :return: None
+        """
+        with self._tx_lock:
+            for tx_class in self._tx_classes[1:]:
+                while tx_class.queue and self._can_send(tx_class):
+                    self._send_now(tx_class.dequeue(), tx_class)
+                if self._tx_count >= MAX_MSG_PER_SEC:
                     break
-                except socket.error as er:
-                    if er.args[0] != EAGAIN:
-                        raise
-                    else:
-                        time.sleep_ms(RE_TX_DELAY)
-                        retries += 1
+
+    def _reset_tx_budget(self):
+        with self._tx_lock:
+            self._tx_count = 0
+            for tx_class in self._tx_classes:
+                tx_class.used = 0
+
+    def _clear_tx(self):
+        with self._tx_lock:
+            for tx_class in self._tx_classes:
+                tx_class.clear()
+
+    def tx_stats(self):
+        """
+        Outbound counters for each priority class.
+        :return: dictionary of PRIO_* class to a dictionary of counters
+        """
+        with self._tx_lock:
+            return dict((tx_class.priority, tx_class.stats()) for tx_class in self._tx_classes)
 
     def _close(self, emsg=None):
+        self._clear_tx()
         self.conn.close()
         self.state = DISCONNECTED
         time.sleep(RECONNECT_DELAY)
@@ -388,13 +698,14 @@ class Blynk:
         c_time = int(time.time())
         if self._m_time != c_time:
             self._m_time = c_time
-            self._tx_count = 0
+            self._reset_tx_budget()
             if self._last_hb_id != 0 and c_time - self._hb_time >= MAX_SOCK_TO:
                 return False
             if c_time - self._hb_time >= HB_PERIOD and self.state == AUTHENTICATED:
                 self._hb_time = c_time
                 self._last_hb_id = self._new_msg_id()
-                self._send(struct.pack(HDR_FMT, MSG_PING, self._last_hb_id, 0), True)
+                self._send(self._encoder.header(MSG_PING, self._last_hb_id, 0), True)
+            self._flush_tx()
         return True
 
     def repl(self, pin):
@@ -404,35 +715,40 @@ class Blynk:
 
     def notify(self, msg):
         if self.state == AUTHENTICATED:
-            self._send(self._format_msg(MSG_NOTIFY, msg))
+            self._send(self._format_msg(MSG_NOTIFY, msg), priority=PRIO_BULK)
 
     def tweet(self, msg):
         if self.state == AUTHENTICATED:
-            self._send(self._format_msg(MSG_TWEET, msg))
+            self._send(self._format_msg(MSG_TWEET, msg), priority=PRIO_BULK)
 
     def email(self, to, subject, body):
         if self.state == AUTHENTICATED:
-            self._send(self._format_msg(MSG_EMAIL, to, subject, body))
+            self._send(self._format_msg(MSG_EMAIL, to, subject, body), priority=PRIO_BULK)
 
     def virtual_write(self, pin, val):
+        self._virtual_write(pin, val, PRIO_TELEMETRY)
+
+    def _virtual_write(self, pin, val, priority):
         if self.state == AUTHENTICATED:
-            self._send(self._format_msg(MSG_HW, 'vw', pin, val))
+            # a queued write to the same pin is replaced, the app only needs the latest value
+            self._send(self._encoder.encode_pin('vw', self._new_msg_id(), pin, val), priority=priority,
+                       key=('vw', pin))
 
     def sync_all(self):
         if self.state == AUTHENTICATED:
-            self._send(self._format_msg(MSG_HW_SYNC))
+            self._send(self._format_msg(MSG_HW_SYNC), priority=PRIO_INTERACTIVE)
 
     def sync_virtual(self, pin):
         if self.state == AUTHENTICATED:
-            self._send(self._format_msg(MSG_HW_SYNC, 'vr', pin))
+            self._send(self._format_msg(MSG_HW_SYNC, 'vr', pin), priority=PRIO_INTERACTIVE)
 
-    def add_virtual_pin(self, pin, read=None, write=None, initial_state=None):
+    def add_virtual_pin(self, pin, read=None, write=None, initial_state=None, cache_ttl=None):
         if isinstance(pin, int) and pin in range(0, MAX_VIRTUAL_PINS):
-            self._vr_pins[pin] = VrPin(read=read, write=write, blynk_ref=self, initial_state=initial_state)
+            self._vr_pins[pin] = VrPin(read=read, write=write, blynk_ref=self, initial_state=initial_state, cache_ttl=cache_ttl)
         else:
             raise ValueError('the pin must be an integer between 0 and %d' % (MAX_VIRTUAL_PINS - 1))
 
-    def add_digital_hw_pin(self, pin, read=None, write=None, inital_state=None):
+    def add_digital_hw_pin(self, pin, read=None, write=None, inital_state=None, cache_ttl=None):
         """
         add a callback for a hw defined pin for digital input/output.
         :param pin: pin number
@@ -442,15 +758,19 @@ class Blynk:
         :param write: called when a value should be written to the hardware.
                         Depending upon how it is setup in the blynk app, will determine
                         if this is wring a digital or analog value.
+        :param cache_ttl: if set, the value returned by 'read' is reused for
+                        this many seconds instead of calling 'read' again.
 
         :return: None
         """
         if isinstance(pin, int):
-            self._digital_hw_pins[pin] = HwPin(read=read, write=write, blynk_ref=self, initial_state=inital_state)
+            self._digital_hw_pins[pin] = HwPin(read=read, write=write, blynk_ref=self, initial_state=inital_state, cache_ttl=cache_ttl)
+            # a registered callback overrides the GPIO backend for this pin
+            self._gpio_pins.pop(pin, None)
         else:
             raise ValueError("pin value must be an integer value")
 
-    def add_analog_hw_pin(self, pin, read=None, write=None, initial_state=None):
+    def add_analog_hw_pin(self, pin, read=None, write=None, initial_state=None, cache_ttl=None):
         """
         add a callback for a hw defined pin for analog input/output.
         :param pin: pin number
@@ -460,15 +780,44 @@ class Blynk:
         :param write: called when a value should be written to the hardware.
                         Depending upon how it is setup in the blynk app, will determine
                         if this is wring a digital or analog value.
+        :param cache_ttl: if set, the value returned by 'read' is reused for
+                        this many seconds instead of calling 'read' again.
 
         :return: None
         """
         if isinstance(pin, int):
-            self._analog_hw_pins[pin] = HwPin(read=read, write=write, blynk_ref=self, initial_state=initial_state)
+            self._analog_hw_pins[pin] = HwPin(read=read, write=write, blynk_ref=self, initial_state=initial_state, cache_ttl=cache_ttl)
+            # a registered callback overrides the GPIO backend for this pin
+            self._gpio_pins.pop(pin, None)
         else:
             raise ValueError("pin value must be an integer value")
 
 
+    def bind_gpio(self, backend):
+        """
+        Serve the hardware pins configured by the Blynk app from a GPIO backend,
+        without user callbacks.  When the app sends the pin modes, the backend
+        is configured and 'dw', 'dr', 'aw' and 'ar' for those pins call the
+        backend directly.  Pins registered with add_digital_hw_pin or
+        add_analog_hw_pin still use their callbacks.
+
+        :param backend: object with the methods:
+                        setPin(pin, value) - digital write
+                        getPin(pin) - digital read
+                        and optionally:
+                        setMode(pin, mode) - mode is one of 'in', 'out', 'pu', 'pd'
+                        setAnalogPin(pin, value) - analog write
+                        getAnalogPin(pin) - analog read
+                        OmegaGPIOHelper can be used as a backend.
+        :return: None
+        """
+        self._gpio = backend
+        self._gpio_write = backend.setPin
+        self._gpio_read = backend.getPin
+        self._gpio_set_mode = getattr(backend, 'setMode', None)
+        self._gpio_analog_write = getattr(backend, 'setAnalogPin', None)
+        self._gpio_analog_read = getattr(backend, 'getAnalogPin', None)
+
     def on_connect(self, func):
         self._on_connect = func
 
@@ -517,8 +866,12 @@ class Blynk:
         self._rx_data = b''
         self._msg_id = 1
         self._pins_configured = False
+        self._gpio_pins = {}
         self._timeout = None
-        self._tx_count = 0
+        # frames queued on a connection that ended with an exception
+        # carry stale msg ids
+        self._clear_tx()
+        self._reset_tx_budget()
         self._m_time = 0
 
         # start all of the tasks, which will be blocked on the
@@ -545,21 +898,20 @@ class Blynk:
                         continue
 
                     self.state = AUTHENTICATING
-                    hdr = struct.pack(HDR_FMT, MSG_LOGIN, self._new_msg_id(), len(self._token))
                     logging.getLogger().debug('Blynk connection successful, authenticating...')
-                    self._send(hdr + self._token, True)
+                    self._send(self._format_msg(MSG_LOGIN, self._token), True)
                     data = self._recv(HDR_LEN, timeout=MAX_SOCK_TO)
                     if not data:
                         self._close('Blynk authentication timed out')
                         continue
 
-                    msg_type, msg_id, status = struct.unpack(HDR_FMT, data)
+                    msg_type, msg_id, status = HDR.unpack(data)
                     if status != STA_SUCCESS or msg_id == 0:
                         self._close('Blynk authentication failed')
                         continue
 
                     self.state = AUTHENTICATED
-                    self._send(self._format_msg(MSG_HW_INFO, "h-beat", HB_PERIOD, 'dev', 'WiPy', "cpu", "CC3200"))
+                    self._send(self._format_msg(MSG_HW_INFO, "h-beat", HB_PERIOD, 'dev', 'WiPy', "cpu", "CC3200"), True)
                     logging.getLogger().debug('Access granted, happy Blynking!')
                     if self._on_connect:
                         self._on_connect()
@@ -568,11 +920,11 @@ class Blynk:
 
             self._hb_time = 0
             self._last_hb_id = 0
-            self._tx_count = 0
+            self._reset_tx_budget()
             while self._do_connect:
                 data = self._recv(HDR_LEN, NON_BLK_SOCK)
                 if data:
-                    msg_type, msg_id, msg_len = struct.unpack(HDR_FMT, data)
+                    msg_type, msg_id, msg_len = HDR.unpack(data)
                     if msg_id == 0:
                         self._close('invalid msg id %d' % msg_id)
                         break
@@ -580,7 +932,7 @@ class Blynk:
                         if msg_id == self._last_hb_id:
                             self._last_hb_id = 0
                     elif msg_type == MSG_PING:
-                        self._send(struct.pack(HDR_FMT, MSG_RSP, msg_id, STA_SUCCESS), True)
+                        self._send(self._encoder.header(MSG_RSP, msg_id, STA_SUCCESS), True)
                     elif msg_type == MSG_HW or msg_type == MSG_BRIDGE:
                         data = self._recv(msg_len, MIN_SOCK_TO)
                         if data:
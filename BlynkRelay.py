@@ -0,0 +1,492 @@
+# Local LAN relay between BlynkLib clients and the Blynk cloud.
+#
+# Local Blynk clients connect to the relay as if it were the Blynk server.
+# The relay keeps the upstream connections to the cloud and:
+#
+# * answers the local heartbeat pings itself, only the relay sends
+#   heartbeats upstream
+# * keeps the upstream connection, and its login, open when a local client
+#   reconnects, so the client reconnect costs no upstream handshake
+# * forwards only the first hardware info message of an upstream session,
+#   and replays the last pin mode message to a client that logs in on a
+#   session that is already authenticated
+# * remaps the message ids of the local clients onto the upstream session,
+#   and routes the responses back with the original ids
+# * batches the uplink messages into one send every BATCH_PERIOD_MS
+#
+# The relay runs in a single thread around select.  Upstream connects and
+# all sends are non-blocking, so a slow or unreachable cloud, or a stalled
+# local client, never stops the relay from serving the other clients.  The server address is resolved
+# when the relay starts, and again in a background thread after an
+# upstream connect fails.
+#
+# The Blynk protocol authenticates one device per connection, so the relay
+# needs one upstream connection per device token that is in use.  Upstream
+# connections that have no local client for UPSTREAM_IDLE_TO are closed.
+#
+# Example usage:
+#
+#     import BlynkRelay
+#
+#     relay = BlynkRelay.BlynkRelay(listen_port=8442)
+#     relay.run()
+#
+#     # and on each local device
+#     blynk = BlynkLib.Blynk(auth_token, server='relay-host', port=8442)
+
+import errno
+import logging
+import select
+import socket
+import threading
+import time
+
+from BlynkLib import HDR_LEN, HDR, MSG_RSP, MSG_LOGIN, MSG_PING, MSG_HW_INFO, MSG_HW, MSG_BRIDGE, \
+    STA_SUCCESS, HB_PERIOD, MAX_SOCK_TO, DISCONNECTED, CONNECTING, AUTHENTICATING, AUTHENTICATED, now_in_ms
+
+STA_SERVER_ERROR = 500
+
+BATCH_PERIOD_MS = 50  # 50 ms
+MAX_BATCH_LEN = 1400  # flush early once a batch fills a packet
+UPSTREAM_IDLE_TO = 60  # 60 seconds
+MAX_PENDING_IDS = 256
+RECV_LEN = 4096
+MAX_SEND_BUF = 65536  # close a connection whose unsent data grows past this
+
+CONNECT_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class FrameReader:
+    """
+    Splits a byte stream into Blynk messages.  A response message has no
+    body, the length field holds the status.
+    """
+    def __init__(self):
+        self._data = b''
+
+    def feed(self, data):
+        self._data += data
+        frames = []
+        while len(self._data) >= HDR_LEN:
+            msg_type, msg_id, msg_len = HDR.unpack(self._data[:HDR_LEN])
+            if msg_type == MSG_RSP:
+                frames.append((msg_type, msg_id, msg_len, b''))
+                self._data = self._data[HDR_LEN:]
+                continue
+            if len(self._data) < HDR_LEN + msg_len:
+                break
+            frames.append((msg_type, msg_id, msg_len, self._data[HDR_LEN:HDR_LEN + msg_len]))
+            self._data = self._data[HDR_LEN + msg_len:]
+        return frames
+
+
+class LocalClient:
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.reader = FrameReader()
+        self.upstream = None
+        self.send_buf = b''  # bytes the non-blocking socket did not take yet
+        self.closed = False
+
+
+class Upstream:
+    def __init__(self, token):
+        self.token = token
+        self.sock = None
+        self.reader = FrameReader()
+        self.state = DISCONNECTED
+        self.client = None
+        self.waiters = []  # (client, local msg id) waiting for the login response
+        self.pending = {}  # upstream msg id -> (client, local msg id)
+        self.out = []
+        self.out_len = 0
+        self.send_buf = b''  # bytes the non-blocking socket did not take yet
+        self.msg_id = 0
+        self.login_id = 0
+        self.info_sent = False
+        self.pm_frame = None  # last pin mode message from the server
+        self.hb_time = 0
+        self.last_hb_id = 0
+        self.idle_since = time.time()
+
+    def new_msg_id(self):
+        self.msg_id += 1
+        if self.msg_id > 0xFFFF:
+            self.msg_id = 1
+        return self.msg_id
+
+
+class BlynkRelay:
+    def __init__(self, server='blynk-cloud.com', port=8442, listen_host='0.0.0.0', listen_port=8442):
+        self._server = server
+        self._port = port
+        self._listen_address = (listen_host, listen_port)
+        self._server_address = None
+        self._resolving = False
+        self._listener = None
+        self._clients = {}  # socket -> LocalClient
+        self._upstreams = {}  # token -> Upstream
+        self._upstream_socks = {}  # socket -> Upstream
+        self._last_flush = 0
+        self._m_time = 0
+        self._stats = {'pings_answered': 0, 'info_dropped': 0, 'frames_up': 0, 'bytes_up': 0,
+                       'sends_up': 0, 'frames_down': 0, 'upstream_logins': 0}
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['clients'] = len(self._clients)
+        stats['upstreams'] = len(self._upstream_socks)
+        return stats
+
+    def _resolve(self):
+        try:
+            self._server_address = socket.getaddrinfo(self._server, self._port)[0][4]
+        except socket.error as exc:
+            logging.getLogger().info('Error: %s, could not resolve %s' % (exc, self._server))
+        finally:
+            self._resolving = False
+
+    def _resolve_in_background(self):
+        if not self._resolving:
+            self._resolving = True
+            the_thread = threading.Thread(target=self._resolve, name='blynk-relay-resolve')
+            the_thread.daemon = True
+            the_thread.start()
+
+    def listen(self):
+        self._resolving = True
+        self._resolve()
+        self._listener = socket.socket()
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self._listen_address)
+        self._listener.listen(16)
+        logging.getLogger().info('Blynk relay listening on %s:%d' % self._listen_address)
+
+    def run(self):
+        """
+        Run the relay in a blocking mode
+        :return:
+        """
+        if self._listener is None:
+            self.listen()
+        while True:
+            self.poll()
+
+    def poll(self, timeout=BATCH_PERIOD_MS / 1000.0):
+        """
+        Handle one round of socket events, flush the uplink batches and
+        send the upstream heartbeats
+        :param timeout: maximum seconds to wait for socket events
+        :return: None
+        """
+        socks = [self._listener] + list(self._clients) + list(self._upstream_socks)
+        writers = [sock for sock, upstream in self._upstream_socks.items()
+                   if upstream.state == CONNECTING or upstream.send_buf]
+        writers += [sock for sock, client in self._clients.items() if client.send_buf]
+        readable, writable, _ = select.select(socks, writers, [], timeout)
+        for sock in writable:
+            if sock in self._clients:
+                self._write_client(self._clients[sock])
+            elif sock in self._upstream_socks:
+                upstream = self._upstream_socks[sock]
+                if upstream.state == CONNECTING:
+                    self._upstream_connected(upstream)
+                else:
+                    self._write_upstream(upstream)
+        for sock in readable:
+            if sock is self._listener:
+                self._accept()
+            elif sock in self._clients:
+                self._read_client(self._clients[sock])
+            elif sock in self._upstream_socks:
+                self._read_upstream(self._upstream_socks[sock])
+
+        now = now_in_ms()
+        if now - self._last_flush >= BATCH_PERIOD_MS:
+            self._last_flush = now
+            for upstream in list(self._upstream_socks.values()):
+                self._flush(upstream)
+
+        c_time = int(time.time())
+        if self._m_time != c_time:
+            self._m_time = c_time
+            for upstream in list(self._upstream_socks.values()):
+                self._upstream_alive(upstream, c_time)
+
+    def _accept(self):
+        sock, address = self._listener.accept()
+        sock.setblocking(False)
+        self._clients[sock] = LocalClient(sock, address)
+        logging.getLogger().debug('local client connected from %s:%d' % address[:2])
+
+    def _close_client(self, client):
+        client.closed = True
+        client.send_buf = b''
+        self._clients.pop(client.sock, None)
+        try:
+            client.sock.close()
+        except socket.error:
+            pass
+        upstream = client.upstream
+        if upstream is not None and upstream.client is client:
+            upstream.client = None
+            upstream.idle_since = time.time()
+        client.upstream = None
+
+    def _send_client(self, client, data):
+        if client.closed:
+            return
+        client.send_buf += data
+        if len(client.send_buf) > MAX_SEND_BUF:
+            logging.getLogger().info('local client %s:%d is not reading, closing it' % client.address[:2])
+            self._close_client(client)
+            return
+        self._write_client(client)
+
+    def _write_client(self, client):
+        """
+        Send as much of the buffered data as the socket takes without blocking.
+        The rest is sent when select reports the socket writable.
+        """
+        try:
+            sent = client.sock.send(client.send_buf)
+        except socket.error as exc:
+            if exc.args[0] not in WOULD_BLOCK:
+                self._close_client(client)
+            return
+        client.send_buf = client.send_buf[sent:]
+
+    def _read_client(self, client):
+        try:
+            data = client.sock.recv(RECV_LEN)
+        except socket.error as exc:
+            if exc.args[0] in WOULD_BLOCK:
+                return
+            data = b''
+        if not data:
+            self._close_client(client)
+            return
+
+        for msg_type, msg_id, msg_len, body in client.reader.feed(data):
+            if client.closed:
+                return
+            if msg_type == MSG_PING:
+                self._stats['pings_answered'] += 1
+                self._send_client(client, HDR.pack(MSG_RSP, msg_id, STA_SUCCESS))
+            elif msg_type == MSG_LOGIN:
+                self._login(client, msg_id, body)
+            elif client.upstream is None:
+                logging.getLogger().info('local client %s:%d sent a message before login' % client.address[:2])
+                self._close_client(client)
+                return
+            elif msg_type == MSG_RSP:
+                # the relay does not forward server requests that need a response
+                pass
+            elif msg_type == MSG_HW_INFO and client.upstream.info_sent:
+                self._stats['info_dropped'] += 1
+            else:
+                upstream = client.upstream
+                if msg_type == MSG_HW_INFO:
+                    upstream.info_sent = True
+                up_id = upstream.new_msg_id()
+                if len(upstream.pending) >= MAX_PENDING_IDS:
+                    upstream.pending.pop(next(iter(upstream.pending)))
+                upstream.pending[up_id] = (client, msg_id)
+                self._queue(upstream, HDR.pack(msg_type, up_id, msg_len) + body)
+
+    def _login(self, client, msg_id, token):
+        upstream = self._upstreams.get(token)
+        if upstream is None:
+            upstream = Upstream(token)
+            self._upstreams[token] = upstream
+        if upstream.client is not None and upstream.client is not client:
+            # the device reconnected before the relay noticed the old connection was gone
+            self._close_client(upstream.client)
+        upstream.client = client
+        client.upstream = upstream
+
+        if upstream.state == AUTHENTICATED:
+            self._send_client(client, HDR.pack(MSG_RSP, msg_id, STA_SUCCESS))
+            # the server only sends the pin modes after its own login, so a
+            # reconnecting client would otherwise never get them
+            if upstream.pm_frame is not None:
+                self._send_client(client, upstream.pm_frame)
+            return
+        upstream.waiters.append((client, msg_id))
+        if upstream.state == DISCONNECTED:
+            self._connect_upstream(upstream)
+
+    def _connect_upstream(self, upstream):
+        """
+        Start a non-blocking connect.  The login is sent from
+        _upstream_connected once select reports the socket writable.
+        """
+        if self._server_address is None:
+            self._resolve_in_background()
+            self._close_upstream(upstream, STA_SERVER_ERROR)
+            return
+        logging.getLogger().debug('TCP: Connecting to %s:%d' % (self._server, self._port))
+        sock = socket.socket()
+        sock.setblocking(False)
+        upstream.sock = sock
+        err = sock.connect_ex(self._server_address)
+        if err not in CONNECT_IN_PROGRESS:
+            self._upstream_failed(upstream, err)
+            return
+        upstream.reader = FrameReader()
+        upstream.send_buf = b''
+        upstream.state = CONNECTING
+        upstream.hb_time = int(time.time())
+        upstream.last_hb_id = 0
+        self._upstream_socks[sock] = upstream
+
+    def _upstream_connected(self, upstream):
+        err = upstream.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self._upstream_failed(upstream, err)
+            return
+        upstream.state = AUTHENTICATING
+        upstream.hb_time = int(time.time())
+        upstream.login_id = upstream.new_msg_id()
+        self._stats['upstream_logins'] += 1
+        self._send_upstream(upstream, HDR.pack(MSG_LOGIN, upstream.login_id, len(upstream.token)) + upstream.token)
+
+    def _upstream_failed(self, upstream, err):
+        logging.getLogger().info('Error: %s, upstream connection failed' % errno.errorcode.get(err, err))
+        # the server may have moved, look it up again for the next connect
+        self._resolve_in_background()
+        self._close_upstream(upstream, STA_SERVER_ERROR)
+
+    def _close_upstream(self, upstream, status=STA_SERVER_ERROR):
+        self._upstream_socks.pop(upstream.sock, None)
+        if upstream.sock is not None:
+            try:
+                upstream.sock.close()
+            except socket.error:
+                pass
+        upstream.sock = None
+        upstream.state = DISCONNECTED
+        upstream.info_sent = False
+        upstream.pending = {}
+        upstream.out = []
+        upstream.out_len = 0
+        upstream.send_buf = b''
+        for client, msg_id in upstream.waiters:
+            self._send_client(client, HDR.pack(MSG_RSP, msg_id, status))
+        upstream.waiters = []
+        # the local client reconnects, and logs in again, on its own
+        if upstream.client is not None:
+            self._close_client(upstream.client)
+        self._upstreams.pop(upstream.token, None)
+
+    def _read_upstream(self, upstream):
+        try:
+            data = upstream.sock.recv(RECV_LEN)
+        except socket.error as exc:
+            if exc.args[0] in WOULD_BLOCK:
+                return
+            data = b''
+        if not data:
+            self._close_upstream(upstream)
+            return
+
+        for msg_type, msg_id, msg_len, body in upstream.reader.feed(data):
+            if upstream.sock is None:
+                # closed while handling an earlier message
+                return
+            if msg_type == MSG_RSP:
+                if upstream.state == AUTHENTICATING and msg_id == upstream.login_id:
+                    if msg_len != STA_SUCCESS:
+                        logging.getLogger().info('Blynk authentication failed for an upstream session')
+                        self._close_upstream(upstream, msg_len)
+                        return
+                    upstream.state = AUTHENTICATED
+                    for client, local_id in upstream.waiters:
+                        self._send_client(client, HDR.pack(MSG_RSP, local_id, STA_SUCCESS))
+                    upstream.waiters = []
+                elif msg_id == upstream.last_hb_id:
+                    upstream.last_hb_id = 0
+                elif msg_id in upstream.pending:
+                    client, local_id = upstream.pending.pop(msg_id)
+                    if client is upstream.client:
+                        self._send_client(client, HDR.pack(MSG_RSP, local_id, msg_len))
+            elif msg_type == MSG_PING:
+                self._send_upstream(upstream, HDR.pack(MSG_RSP, msg_id, STA_SUCCESS))
+            elif msg_type == MSG_HW or msg_type == MSG_BRIDGE:
+                frame = HDR.pack(msg_type, msg_id, msg_len) + body
+                if msg_type == MSG_HW and body.startswith(b'pm\0'):
+                    upstream.pm_frame = frame
+                if upstream.client is not None:
+                    self._stats['frames_down'] += 1
+                    self._send_client(upstream.client, frame)
+            else:
+                logging.getLogger().debug('relay dropped upstream message type %d' % msg_type)
+
+    def _queue(self, upstream, frame):
+        upstream.out.append(frame)
+        upstream.out_len += len(frame)
+        self._stats['frames_up'] += 1
+        if upstream.out_len >= MAX_BATCH_LEN:
+            self._flush(upstream)
+
+    def _flush(self, upstream):
+        if not upstream.out or upstream.state != AUTHENTICATED:
+            return
+        data = b''.join(upstream.out)
+        upstream.out = []
+        upstream.out_len = 0
+        self._send_upstream(upstream, data)
+
+    def _send_upstream(self, upstream, data):
+        if upstream.sock is None:
+            return
+        upstream.send_buf += data
+        if len(upstream.send_buf) > MAX_SEND_BUF:
+            logging.getLogger().info('Blynk server is not reading for an upstream session')
+            self._close_upstream(upstream)
+            return
+        if upstream.state != CONNECTING:
+            self._write_upstream(upstream)
+
+    def _write_upstream(self, upstream):
+        """
+        Send as much of the buffered data as the socket takes without blocking.
+        The rest is sent when select reports the socket writable.
+        """
+        try:
+            sent = upstream.sock.send(upstream.send_buf)
+        except socket.error as exc:
+            if exc.args[0] in WOULD_BLOCK:
+                return
+            self._close_upstream(upstream)
+            return
+        upstream.send_buf = upstream.send_buf[sent:]
+        self._stats['sends_up'] += 1
+        self._stats['bytes_up'] += sent
+
+    def _upstream_alive(self, upstream, c_time):
+        if upstream.state == CONNECTING and c_time - upstream.hb_time >= MAX_SOCK_TO:
+            logging.getLogger().info('Blynk connection timed out for an upstream session')
+            self._close_upstream(upstream)
+        elif upstream.state == AUTHENTICATING and c_time - upstream.hb_time >= MAX_SOCK_TO:
+            logging.getLogger().info('Blynk authentication timed out for an upstream session')
+            self._close_upstream(upstream)
+        elif upstream.state != AUTHENTICATED:
+            return
+        elif upstream.last_hb_id != 0 and c_time - upstream.hb_time >= MAX_SOCK_TO:
+            logging.getLogger().info('Blynk server is offline for an upstream session')
+            self._close_upstream(upstream)
+        elif upstream.client is None and time.time() - upstream.idle_since >= UPSTREAM_IDLE_TO:
+            logging.getLogger().debug('closing idle upstream session')
+            self._close_upstream(upstream)
+        elif c_time - upstream.hb_time >= HB_PERIOD:
+            upstream.hb_time = c_time
+            upstream.last_hb_id = upstream.new_msg_id()
+            self._send_upstream(upstream, HDR.pack(MSG_PING, upstream.last_hb_id, 0))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    BlynkRelay().run()
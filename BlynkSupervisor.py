@@ -0,0 +1,237 @@
+# Run many Blynk device sessions across a pool of worker processes.
+#
+# A single python process running many Blynk instances is limited to one
+# core.  BlynkSupervisor shards the device tokens across worker processes,
+# one per core by default.  Each worker runs the Blynk instances for its
+# tokens, and the parent talks to the workers over a pipe so it can still
+# call virtual_write for any device and collect the metrics of all devices.
+# Workers that exit are restarted with the same tokens.
+#
+# Limitation: Blynk.run is a blocking loop, so a worker runs each of its
+# devices in its own thread rather than from one event loop.  Every idle
+# session wakes up every IDLE_TIME_MS (5 ms), so a worker with N devices
+# does about 200 * N wakeups per second, all contending for that worker's
+# GIL.  Sharding spreads this cost over the cores but does not remove it.
+# Keep the number of devices per worker in the tens, and add workers
+# rather than devices per worker.
+#
+# Example usage:
+#
+#     import BlynkSupervisor
+#
+#     # called in the worker process for every device, register the pins here
+#     # (must be a module level function so it can be sent to the worker)
+#     def setup_device(blynk):
+#         blynk.add_virtual_pin(1, write=v1_write_handler)
+#
+#     supervisor = BlynkSupervisor.BlynkSupervisor(tokens, setup=setup_device)
+#     supervisor.start()
+#     supervisor.virtual_write(tokens[0], 5, 100)
+#     print(supervisor.stats())
+
+import logging
+import multiprocessing
+import threading
+import time
+
+import BlynkLib
+
+MONITOR_PERIOD = 1  # 1 second
+CMD_TIMEOUT = 5  # 5 seconds
+
+CMD_VIRTUAL_WRITE = 'virtual_write'
+CMD_STATS = 'stats'
+CMD_STOP = 'stop'
+
+
+def _worker_main(worker_id, tokens, setup, blynk_kwargs, conn):
+    """
+    Entry point of a worker process.  Starts one Blynk instance per token,
+    each in its own thread (see the limitation above), then serves commands
+    from the parent.
+    """
+    blynks = {}
+    for token in tokens:
+        blynk = BlynkLib.Blynk(token, **blynk_kwargs)
+        if setup is not None:
+            setup(blynk)
+        blynks[token] = blynk
+        the_thread = threading.Thread(target=blynk.run, name='blynk-%s' % token)
+        the_thread.daemon = True
+        the_thread.start()
+
+    logging.getLogger().debug('worker %d running %d devices' % (worker_id, len(tokens)))
+    while True:
+        try:
+            cmd = conn.recv()
+        except (EOFError, IOError):
+            # the parent went away
+            return
+
+        if cmd[0] == CMD_VIRTUAL_WRITE:
+            token, pin, val = cmd[1:]
+            if token in blynks:
+                blynks[token].virtual_write(pin, val)
+            else:
+                logging.getLogger().warn('Warning: worker %d has no device %s' % (worker_id, token))
+        elif cmd[0] == CMD_STATS:
+            # echo the request sequence number, so the parent can discard late replies
+            conn.send((cmd[1], dict((token, {'state': blynk.state, 'tx': blynk.tx_stats()})
+                                    for token, blynk in blynks.items())))
+        elif cmd[0] == CMD_STOP:
+            return
+        else:
+            logging.getLogger().warn('Warning: worker %d unknown command: %s' % (worker_id, cmd[0]))
+
+
+class Worker:
+    def __init__(self, worker_id, tokens):
+        self.worker_id = worker_id
+        self.tokens = tokens
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock()
+        self.restarts = 0
+        self.seq = 0
+
+
+class BlynkSupervisor:
+    def __init__(self, tokens, setup=None, workers=None, **blynk_kwargs):
+        """
+        :param tokens: list of device tokens
+        :param setup: called as setup(blynk) in the worker process for every
+                      device, before it is run.  Use it to register pins and
+                      user tasks.
+        :param workers: number of worker processes, defaults to the number of cores
+        :param blynk_kwargs: passed to every BlynkLib.Blynk instance, e.g. server, port
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, len(tokens)))
+        self._setup = setup
+        self._blynk_kwargs = blynk_kwargs
+        self._workers = [Worker(i, list(tokens[i::workers])) for i in range(workers)]
+        self._token_worker = {}
+        for worker in self._workers:
+            for token in worker.tokens:
+                self._token_worker[token] = worker
+        self._running = False
+        self._monitor = None
+
+    def _start_worker(self, worker):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        worker.process = multiprocessing.Process(target=_worker_main,
+                                                 args=(worker.worker_id, worker.tokens, self._setup,
+                                                       self._blynk_kwargs, child_conn),
+                                                 name='blynk-worker-%d' % worker.worker_id)
+        worker.process.daemon = True
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+
+    def start(self, monitor=True):
+        """
+        Start all of the workers.
+        :param monitor: True - restart workers from a background thread when they exit
+                        False - the caller is expected to call check_workers
+        :return: None
+        """
+        self._running = True
+        for worker in self._workers:
+            with worker.lock:
+                self._start_worker(worker)
+        if monitor:
+            self._monitor = threading.Thread(target=self._monitor_workers, name='blynk-supervisor')
+            self._monitor.daemon = True
+            self._monitor.start()
+
+    def stop(self):
+        self._running = False
+        for worker in self._workers:
+            with worker.lock:
+                try:
+                    worker.conn.send((CMD_STOP,))
+                except (EOFError, IOError):
+                    pass
+                worker.process.join(CMD_TIMEOUT)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+                worker.conn.close()
+
+    def check_workers(self):
+        """
+        Restart any worker process that has exited, with the same devices.
+        :return: number of workers restarted
+        """
+        restarted = 0
+        for worker in self._workers:
+            with worker.lock:
+                if self._running and not worker.process.is_alive():
+                    logging.getLogger().info('worker %d exited with code %s, restarting'
+                                             % (worker.worker_id, worker.process.exitcode))
+                    worker.conn.close()
+                    self._start_worker(worker)
+                    worker.restarts += 1
+                    restarted += 1
+        return restarted
+
+    def _monitor_workers(self):
+        while self._running:
+            try:
+                self.check_workers()
+            except Exception as exc:
+                logging.getLogger().error('Error in supervisor monitor: {}'.format(exc))
+            time.sleep(MONITOR_PERIOD)
+
+    def virtual_write(self, token, pin, val):
+        """
+        Virtual write to the device with the given token, in whichever worker runs it.
+        """
+        if token not in self._token_worker:
+            raise ValueError('unknown device token: %s' % token)
+        worker = self._token_worker[token]
+        with worker.lock:
+            try:
+                worker.conn.send((CMD_VIRTUAL_WRITE, token, pin, val))
+            except (EOFError, IOError):
+                # the worker exited and is restarted by check_workers
+                logging.getLogger().warn('Warning: worker %d is down, dropped virtual write to %s pin %d'
+                                         % (worker.worker_id, token, pin))
+
+    def stats(self):
+        """
+        Metrics from all of the workers.
+        :return: dictionary with 'devices', the state and tx counters of each device,
+                 'tx', the tx counters summed per priority class, and 'workers',
+                 the liveness and restart count of each worker
+        """
+        devices = {}
+        workers = {}
+        for worker in self._workers:
+            with worker.lock:
+                alive = worker.process.is_alive()
+                workers[worker.worker_id] = {'alive': alive, 'restarts': worker.restarts,
+                                             'devices': len(worker.tokens)}
+                if not alive:
+                    continue
+                worker.seq += 1
+                try:
+                    worker.conn.send((CMD_STATS, worker.seq))
+                    deadline = time.time() + CMD_TIMEOUT
+                    while worker.conn.poll(max(0, deadline - time.time())):
+                        seq, reply = worker.conn.recv()
+                        if seq == worker.seq:
+                            devices.update(reply)
+                            break
+                        # a late reply to an earlier request that timed out
+                except (EOFError, IOError):
+                    pass
+
+        tx = {}
+        for device in devices.values():
+            for priority, counters in device['tx'].items():
+                totals = tx.setdefault(priority, {})
+                for name, value in counters.items():
+                    if name != 'share':
+                        totals[name] = totals.get(name, 0) + value
+        return {'devices': devices, 'tx': tx, 'workers': workers}
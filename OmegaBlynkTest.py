@@ -40,17 +40,6 @@ def user_task_handler(task_state, blynk_ref):
     blynk_ref.virtual_write(33, 255 * task_state['led_state'])
 
 
-def hw0_write_handler(value, pin, state, blynk_ref):
-    logging.getLogger().debug("HW0 write value: {}".format(value))
-    gpio.setPin(0, value)
-
-
-def hw26_read_handler(pin, state, blynk_ref):
-    pin26 = gpio.getPin(pin)
-    logging.getLogger().debug("hw26_read_handler: {}".format(pin26))
-    return pin26
-
-
 def hw1_read_handler(pin, state, blynk_ref):
     value = get_random_digital_value()
     return value
@@ -69,11 +58,12 @@ auth_token = ''
 blynk = BlynkLib.Blynk(auth_token)
 blynk.add_user_task(user_task_handler, 2, {'led_state': 0})
 blynk.add_user_task(user_task_handler_2, 2)
-blynk.add_digital_hw_pin(0, write=hw0_write_handler)
+# hardware pins set up in the Blynk app, like 0 and 26, are served by the GPIO helper
+blynk.bind_gpio(gpio)
+# pin 1 is overridden by a callback
 blynk.add_digital_hw_pin(1, read=hw1_read_handler)
 blynk.add_virtual_pin(127, write=v127_write_handler)
 blynk.add_virtual_pin(126, read=v126_read_handler)
-blynk.add_digital_hw_pin(26, read=hw26_read_handler)
 
 logging.getLogger().info("Running...")
 blynk.run()
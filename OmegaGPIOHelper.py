@@ -9,6 +9,9 @@ https://community.onion.io/topic/40/simple-python-wrapper-and-demo
 Enhanced to handle:
 * pin 8:  for some reason pin 8 did not respond without using fast-gpio
 * added platform support
+* added setMode, so it can be used as a BlynkLib GPIO backend.  Once a pin
+  mode is set, setPin and getPin only rewrite the pin direction when it
+  changes
 
 """
 
@@ -32,12 +35,26 @@ class OmegaGPIOHelper(object):
             subprocess.call(['fast-gpio', 'set', str(pin_number), str(state)])
 
     def __init__(self):
+        self._directions = {}
         if platform.system() == 'Linux':
             for pin in self.pins:
                 fd = open(self.exportPath, 'w')
                 fd.write(str(pin))
                 fd.close()
 
+    def setMode(self, pin, mode):
+        """
+        Set the pin direction.  mode is one of the Blynk pin modes 'in', 'out',
+        'pu' or 'pd'.  The Omega sysfs interface has no pull up or pull down,
+        so 'pu' and 'pd' are inputs.
+        """
+        direction = "out" if mode == 'out' else "in"
+        if platform.system() == "Linux" and pin != 8:
+            fd = open(self.pinDirectionPath.replace("$", str(pin)), 'w')
+            fd.write(direction)
+            fd.close()
+        self._directions[pin] = direction
+
     def on(self, pin):
         self.setPin(pin, 1)
 
@@ -60,9 +77,12 @@ class OmegaGPIOHelper(object):
             self._write(8, value)
         else:
             # Set direction as out
-            fd = open(self.pinDirectionPath.replace("$", str(pin)), 'w')
-            fd.write("out")
-            fd.close()
+            if self._directions.get(pin) != "out":
+                fd = open(self.pinDirectionPath.replace("$", str(pin)), 'w')
+                fd.write("out")
+                fd.close()
+                if pin in self._directions:
+                    self._directions[pin] = "out"
 
             # Set value
             fd = open(self.pinValuePath.replace("$", str(pin)), 'w')
@@ -80,12 +100,15 @@ class OmegaGPIOHelper(object):
             return int(value)
 
         # Set direction as in
-        try:
-            fd = open(self.pinDirectionPath.replace("$", str(pin)), 'w')
-            fd.write("in")
-            fd.close()
-        except:
-            pass
+        if self._directions.get(pin) != "in":
+            try:
+                fd = open(self.pinDirectionPath.replace("$", str(pin)), 'w')
+                fd.write("in")
+                fd.close()
+                if pin in self._directions:
+                    self._directions[pin] = "in"
+            except:
+                pass
 
         # Get value
         fd = open(self.pinValuePath.replace("$", str(pin)), 'r')